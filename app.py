@@ -2,7 +2,8 @@
 """
 App file for Museum Conventus website. It uses a database to store API information from three museums.
 Each museum has a slighly different structure to their JSON response, so three functions run at the same time to collect the information and store it.
-The database is cleared for every new search.
+The database is cleared for every new search. It is kept in memory, so the app must run as a single process
+(e.g. the default flask run); requests within that process take turns using the database.
 
 Usage: 
 --> export DATABASE_URL=“postgresql://localhost/Project”
@@ -13,11 +14,14 @@ By: Nidanu O'Shea
 
 # Imports
 import os
+import atexit
 import asyncio
-from flask import Flask, redirect, render_template, request, session
+import threading
+from flask import Flask, g, jsonify, redirect, render_template, request, session
 from flask_session import Session
 from helpers import *
-from sqlalchemy import func
+from sqlalchemy import event, func
+from sqlalchemy.pool import StaticPool
 
 app = Flask(__name__)
 app.debug = True
@@ -25,7 +29,10 @@ app.debug = True
 # Configure session to use filesystem
 app.config["SESSION_PERMANENT"] = False
 app.config["SESSION_TYPE"] = "filesystem"
-app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///museumconventus.db'
+
+# The database only holds the current search, so it is kept in memory on a single shared connection
+app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {"query_cache_size": 1200, "poolclass": StaticPool, "connect_args": {"check_same_thread": False}}
 
 # Check for environment variable
 if not os.getenv("DATABASE_URL"):
@@ -35,34 +42,129 @@ if not os.getenv("DATABASE_URL"):
 db.init_app(app)
 Session(app)
 
+with app.app_context():
+
+    # SQLite settings, applied to the connection when it is opened
+    @event.listens_for(db.engine, "connect")
+    def set_sqlite_pragma(dbapi_connection, connection_record):
+        """Keeps temporary tables and indexes, e.g. for sorting and DISTINCT, in memory like the database itself."""
+
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+
+    # Create a fresh database table once at startup
+    db.drop_all()
+    db.create_all()
+
+# Every thread shares the single in-memory connection, so requests using the database take turns
+db_lock = threading.Lock()
+
+@app.before_request
+def lock_database():
+    """Waits until no other request is using the database connection."""
+
+    if request.endpoint != "static":
+        db_lock.acquire()
+        g.database_locked = True
+
+@app.teardown_request
+def unlock_database(exception):
+    """Ends this request's database session before another request can use the connection."""
+
+    if g.pop("database_locked", False):
+        db.session.remove()
+        db_lock.release()
+
+# Background event loop owning the aiohttp session shared by all searches
+loop = asyncio.new_event_loop()
+threading.Thread(target=loop.run_forever, daemon=True).start()
+app.aiohttp_session = asyncio.run_coroutine_threadsafe(create_session(), loop).result()
+
+@atexit.register
+def close_aiohttp_session():
+    """Close the shared aiohttp session when the app shuts down."""
+
+    asyncio.run_coroutine_threadsafe(app.aiohttp_session.close(), loop).result()
+
+async def collect_data(keyword):
+    """Runs on the background loop, with an app context so the fetchers can use the database."""
+
+    with app.app_context():
+        await get_data(app.aiohttp_session, keyword)
+
+def load_rijks_details(artworks):
+    """Fetches the details of the given Rijksmuseum artworks that don't have them yet and stores them."""
+
+    pending = [artwork for artwork in artworks if artwork.museum == "Rijksmuseum" and artwork.medium is None]
+    if len(pending) > 0:
+        details = asyncio.run_coroutine_threadsafe(fetch_rijks_details(app.aiohttp_session, [artwork.id for artwork in pending]), loop).result()
+        for artwork, (medium, date) in zip(pending, details):
+            artwork.medium = medium
+            artwork.date = date
+        db.session.commit()
+
+        # New mediums become available to filter over
+        session["mediums"] = sorted(set(session["mediums"]) | {artwork.medium for artwork in pending if artwork.medium})
+
+def load_all_rijks_details():
+    """Filtering on medium or date needs the details of every Rijksmuseum artwork, not only the displayed ones."""
+
+    load_rijks_details(Artwork.query.filter(Artwork.museum == "Rijksmuseum", Artwork.medium.is_(None)).all())
+
+def filter_conditions(selectedTypes, fromDate, toDate):
+    """Builds the filter conditions, the date range first as it is usually the most selective."""
+
+    conditions = []
+    if fromDate and toDate:
+        conditions.append(Artwork.date.between(fromDate, toDate))
+    elif fromDate:
+        conditions.append(Artwork.date >= fromDate)
+    elif toDate:
+        conditions.append(Artwork.date <= toDate)
+    if selectedTypes:
+        conditions.append(Artwork.medium.in_(selectedTypes))
+    return conditions
+
+def filtered_works(selectedTypes, fromDate, toDate, page, per_page):
+    """Paginates the (filtered) results, ordered by title and artist, with Rijksmuseum details loaded."""
+
+    conditions = filter_conditions(selectedTypes, fromDate, toDate)
+    if len(conditions) > 0:
+        load_all_rijks_details()
+    works = Artwork.query.filter(*conditions).order_by(Artwork.title, Artwork.artist).paginate(page=page, per_page=per_page, count=True)
+    load_rijks_details(works.items)
+    return works
+
 @app.route("/")
 def index():
     """Route to home page."""
 
-    # Clear database and session
-    session.clear()
-    db.drop_all()
-    db.create_all()
-    
     return redirect("/search")
 
 @app.route("/search", methods=["GET", "POST"])
 def search():
     """Obtains keyword and runs functions to collect data."""
 
-    # Clear database and session
+    # Clear session
     session.clear()
-    db.drop_all()
-    db.create_all()
 
     if request.method == "POST":
 
+        # Clear results of the previous search, keeping the table and its indexes
+        Artwork.query.delete()
+        db.session.commit()
+
         # Save the user's search term
         keyword = request.form.get("keyword")
         session["keyword"] = keyword
 
         # Obtain API data: see helpers.py
-        asyncio.run(get_data(keyword))
+        asyncio.run_coroutine_threadsafe(collect_data(keyword), loop).result()
+
+        # Lists all possible mediums listed for the keyword, only changes with a new search
+        mediums = db.session.query(Artwork.medium).filter(Artwork.medium != '').distinct().order_by(Artwork.medium).all()
+        session["mediums"] = [medium for (medium,) in mediums]
 
         return redirect("/results")
     else:
@@ -74,26 +176,28 @@ def results():
 
     header = f"Search results for '{session['keyword']}'"
 
-    # No selected checkboxes
-    selectedTypes = []
-
-    # Lists all possible mediums listed for the keyword 
-    mediums = db.session.execute("SELECT medium FROM Artwork GROUP BY medium ORDER BY medium ASC").fetchall()
-    mediums = [medium[0] for medium in mediums if medium[0] != ''] 
+    # Filters kept in the URL when changing page, none after a new search
+    selectedTypes = request.args.getlist('selectedTypes[]')
+    fromDate = request.args.get('fromDate')
+    toDate = request.args.get('toDate')
 
     # Number of results per page
     page = request.args.get('page', 1, type=int)
     per_page = 20
 
-    # Counts number of results
-    total_results = Artwork.query.count()
+    # Results ordered by their title and artist
+    works = filtered_works(selectedTypes, fromDate, toDate, page, per_page)
+
+    # Lists all possible mediums listed for the keyword 
+    mediums = session["mediums"]
+
+    # Counts number of results, already computed by the pagination
+    total_results = works.total
 
     if total_results == 0:
         header = f"No results for '{session['keyword']}'"
 
-    # Results ordered by their ID
-    works = Artwork.query.order_by(Artwork.title, Artwork.artist).paginate(page=page, per_page=per_page)
-    return render_template("results.html", header=header, works=works, mediums=mediums, total_results=total_results, selectedTypes=selectedTypes)
+    return render_template("results.html", header=header, works=works, mediums=mediums, total_results=total_results, selectedTypes=selectedTypes, fromDate=fromDate, toDate=toDate)
 
 @app.route('/apply_filter', methods=['POST'])
 def apply_filter():
@@ -113,35 +217,36 @@ def apply_filter():
     page = request.args.get('page', 1, type=int)
     per_page = 20
 
-    # Possible mediums to filter over
-    mediums = db.session.execute("SELECT medium FROM Artwork GROUP BY medium ORDER BY medium ASC").fetchall()
-    mediums = [medium[0] for medium in mediums if medium[0] != ''] 
     header = f"Search results for '{session['keyword']}'"
 
-    # If any checkboxes are checked
-    if len(selectedTypes) > 0:
-
-        # Checks if date restrictions have been added
-        if fromDate and toDate:
-            works = Artwork.query.filter((Artwork.medium.in_(selectedTypes)), (Artwork.date >= fromDate),(Artwork.date <= toDate)).paginate(page=page, per_page=per_page)
-            total_results = Artwork.query.filter((Artwork.medium.in_(selectedTypes)), (Artwork.date >= fromDate),(Artwork.date <= toDate)).count()
-        elif fromDate:
-            works = Artwork.query.filter((Artwork.medium.in_(selectedTypes)), (Artwork.date >= fromDate)).paginate(page=page, per_page=per_page)
-            total_results = Artwork.query.filter((Artwork.medium.in_(selectedTypes)), (Artwork.date >= fromDate)).count()
-        elif toDate:
-            works = Artwork.query.filter((Artwork.medium.in_(selectedTypes)),(Artwork.date <= toDate)).paginate(page=page, per_page=per_page)
-            total_results = Artwork.query.filter_by((Artwork.medium.in_ in selectedTypes),(Artwork.date <= toDate)).count()
-        else:
-            works = Artwork.query.filter((Artwork.medium.in_(selectedTypes))).paginate(page=page, per_page=per_page)
-            total_results = Artwork.query.filter((Artwork.medium.in_(selectedTypes)))
-    
-    # If no filters selected
-    else:
-        total_results = Artwork.query.count()
-        selectedTypes = []
-        works = Artwork.query.order_by(Artwork.id).paginate(page=page, per_page=per_page)
+    # Filtered results, ordered as on the results page
+    works = filtered_works(selectedTypes, fromDate, toDate, page, per_page)
+
+    # Possible mediums to filter over
+    mediums = session["mediums"]
+
+    # Counts number of results, already computed by the pagination
+    total_results = works.total
+
+    return render_template("results.html", header=header, works=works, mediums=mediums, total_results=total_results, selectedTypes=selectedTypes, fromDate=fromDate, toDate=toDate)
+
+@app.route("/api/results", methods=["GET"])
+def api_results():
+    """Returns a page of (filtered) results as JSON, so changing page only re-renders the artworks in results.html."""
+
+    # Same filters as apply_filter, sent as query arguments
+    selectedTypes = request.args.getlist('selectedTypes[]')
+    fromDate = request.args.get('fromDate')
+    toDate = request.args.get('toDate')
+
+    # Number of results per page
+    page = request.args.get('page', 1, type=int)
+    per_page = 20
+
+    works = filtered_works(selectedTypes, fromDate, toDate, page, per_page)
 
-    return render_template("results.html", header=header, works=works, mediums=mediums, total_results=total_results, selectedTypes=selectedTypes)
+    artworks = [{"title": artwork.title, "artist": artwork.artist, "date": artwork.date, "url": artwork.url, "image_url": artwork.image_url, "museum": artwork.museum, "museum_url": artwork.museum_url} for artwork in works.items]
+    return jsonify(works=artworks, mediums=session["mediums"], total=works.total, page=works.page, pages=list(works.iter_pages()), has_prev=works.has_prev, has_next=works.has_next, prev_num=works.prev_num, next_num=works.next_num)
     
 @app.route("/museums", methods=["POST", "GET"])
 def museums():
@@ -5,145 +5,200 @@ By: Nidanu O'Shea
 """
 
 # Imports
+import asyncio
+import logging
 import aiohttp
-import requests
+import orjson
+from urllib.parse import quote_plus
+from aiohttp_client_cache import CachedSession, SQLiteBackend
+from aiolimiter import AsyncLimiter
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import insert
 
 db = SQLAlchemy()
+logger = logging.getLogger(__name__)
+
+# The MET API allows 80 requests per second: cap the request rate, requests in flight are capped by the connector's per host limit
+met_rate = AsyncLimiter(80, 1)
 
 # Database table format
 class Artwork(db.Model):
     __tablename__ = 'artwork'
-    hash = db.Column(db.Integer, primary_key=True, nullable=False)
-    id = db.Column(db.String)
+    id = db.Column(db.String, primary_key=True)
     title = db.Column(db.String)
     artist = db.Column(db.String)
     medium = db.Column(db.String)
     date = db.Column(db.String)
     url = db.Column(db.String)
     image_url = db.Column(db.String)
-    museum = db.Column(db.String)
+    museum = db.Column(db.String, primary_key=True)
     museum_url = db.Column(db.String)
 
+    # Indexes for filtering by medium and date (which also serves listing mediums), and ordering by title and artist
+    __table_args__ = (
+        db.Index('ix_art_medium_date', 'medium', 'date'),
+        db.Index('ix_art_title_artist', 'title', 'artist'),
+    )
+
+# API URLs
+MET_OBJECT_URL = "https://collectionapi.metmuseum.org/public/collection/v1/objects/"
+
+# JSON keys of each museum's records, mapped to their Artwork columns
+VA_FIELDS = (("id", "systemNumber"), ("title", "_primaryTitle"), ("medium", "objectType"), ("date", "_primaryDate"))
+MET_FIELDS = (("id", "objectID"), ("title", "title"), ("artist", "artistDisplayName"), ("url", "objectURL"), ("date", "objectDate"), ("medium", "objectName"))
+RIJKS_FIELDS = (("id", "objectNumber"), ("title", "title"), ("artist", "principalOrFirstMaker"))
+
+async def create_session():
+    """Create the aiohttp session shared by every search, so connections to each museum are kept alive.
+    Responses are cached for an hour, so repeated searches for a keyword skip the museum APIs."""
+
+    connector = aiohttp.TCPConnector(limit=100, limit_per_host=20, ttl_dns_cache=300)
+    cache = SQLiteBackend("api_cache", expire_after=3600)
+    return CachedSession(cache=cache, connector=connector, json_serialize=lambda obj: orjson.dumps(obj).decode())
+
 async def fetch_data(session, url):
     """Function to speed up API data collection."""
 
     async with session.get(url) as response:
-        return await response.json()
+        return await response.json(loads=orjson.loads)
+
+async def fetch_met_object(session, url):
+    """Fetch from the MET API while staying under its rate limit."""
+
+    async with met_rate:
+        return await fetch_data(session, url)
     
-async def fetch_va_data(keyword):
+async def fetch_va_data(session, keyword):
     """Obtain information from VICTORIA & ALBERT MUSEUM API. Initial call returns info over all results.
     The V&A API only permits a maximum of 100 results per call."""
 
-    async with aiohttp.ClientSession() as session:
-        
-        # JSON response
-        va_response = requests.get("https://api.vam.ac.uk/v2/objects/search?q=%s&page_size=100" % keyword)
-        va_jsondata = va_response.json()
-
-        if 'records' in va_jsondata.keys():
-            va_json = va_jsondata["records"]
-        for i in range(len(va_json)):
-            if va_json[i]["systemNumber"] is not None:
-                id = va_json[i]["systemNumber"]
-                title = va_json[i]["_primaryTitle"]
-                if 'name' in va_json[i]["_primaryMaker"].keys():
-                    artist = va_json[i]["_primaryMaker"]["name"]
-                url = "https://collections.vam.ac.uk/item/%s" % (id)
-                medium = va_json[i]["objectType"]
-                date = va_json[i]["_primaryDate"]
-                if va_json[i]["_primaryImageId"] is not None:
-                    image_url = va_json[i]["_images"]["_primary_thumbnail"]
-                else:
-                    image_url = "static/no_image.jpg"
-                museum = "Victoria and Albert Museum"
-                museum_url = "https://www.vam.ac.uk/"
-               
-               # Add artwork to database
-                artwork = Artwork(hash=hash(id), id=id, title=title, artist=artist, medium=medium, date=date, url=url, image_url=image_url, museum=museum, museum_url=museum_url)
-                db.session.add(artwork)
-                db.session.commit()
-
-async def fetch_met_data(keyword):
+    artworks = []
+
+    # JSON response
+    va_jsondata = await fetch_data(session, f"https://api.vam.ac.uk/v2/objects/search?q={quote_plus(keyword)}&page_size=100")
+
+    # No results found in the V&A collection
+    va_json = va_jsondata.get("records")
+    if not va_json:
+        return
+
+    for record in va_json:
+        if record["systemNumber"] is not None:
+            row = {column: record.get(key) for column, key in VA_FIELDS}
+            row["artist"] = record["_primaryMaker"].get("name")
+            row["url"] = f"https://collections.vam.ac.uk/item/{row['id']}"
+            if record["_primaryImageId"] is not None:
+                row["image_url"] = record["_images"]["_primary_thumbnail"]
+            else:
+                row["image_url"] = "static/no_image.jpg"
+
+            # Queue artwork for the database
+            artworks.append(dict(row, museum="Victoria and Albert Museum", museum_url="https://www.vam.ac.uk/"))
+
+    # Add all artworks to database in one transaction
+    if len(artworks) > 0:
+        db.session.execute(insert(Artwork.__table__), artworks)
+        db.session.commit()
+
+async def fetch_met_data(session, keyword):
     """Obtain information from METROPOLITAN MUSEUM OF ART API. First call returns list of all object IDs.
     Second call returns information of each object using their ID. The API is limited to 80 requests per second,
     so the number of results is capped at 100 to speed up the website."""
 
-    async with aiohttp.ClientSession() as session:
-
-        # JSON response: First call
-        met_response = requests.get("https://collectionapi.metmuseum.org/public/collection/v1/search?q=%s" % keyword)
-        met_jsondata = met_response.json()
-        met_IDs = []
-        if 'objectIDs' in met_jsondata.keys():
-            met_IDs = list(met_jsondata["objectIDs"])
-
-        # If results found in the MET collection
-        if len(met_IDs) > 0:
-            for i in range(100):
-
-                # Second call
-                metID_response = requests.get("https://collectionapi.metmuseum.org/public/collection/v1/objects/%s" % met_IDs[i]) 
-                metID_jsondata = metID_response.json()
-                if 'objectID' in metID_jsondata.keys():
-                    id = metID_jsondata["objectID"]
-                    title = metID_jsondata["title"]
-                    artist = metID_jsondata["artistDisplayName"]
-                    url = metID_jsondata["objectURL"]
-                    date = metID_jsondata["objectDate"]
-                    medium = metID_jsondata["objectName"]
-                    if metID_jsondata["isPublicDomain"] is True:
-                        image_url = metID_jsondata["primaryImage"]
-                    else:
-                        image_url = "static/no_image.jpg"
-                    museum = "Metropolitan Museum of Art"
-                    museum_url= "https://www.metmuseum.org/"
-
-                    # Add artwork to database
-                    artwork = Artwork(hash=hash(id), id=id, title=title, artist=artist, medium=medium, date=date, url=url, image_url=image_url, museum=museum, museum_url=museum_url)
-                    db.session.add(artwork)
-                    db.session.commit()
-
-async def fetch_rijks_data(keyword):
-    """Obtain information from RIJKSMUSEUM API. Initial call returns basic info over all results.
-    Second call returns item specific information, i.e., the item ID is used to obtain details."""
-
-    async with aiohttp.ClientSession() as session:
-
-        # JSON response: First call
-        rijks_response = requests.get("https://www.rijksmuseum.nl/api/en/collection?key=D82d0Rur&q=%s" % keyword)
-        rijks_jsondata = rijks_response.json()
-        if 'artObjects' in rijks_jsondata.keys():
-            rijks_json = rijks_jsondata["artObjects"]
-        for i in range(len(rijks_json)):
-            id = rijks_json[i]["objectNumber"]
-            title = rijks_json[i]["title"]
-            artist = rijks_json[i]["principalOrFirstMaker"]
-            url = rijks_json[i]["links"]["web"]
-            if rijks_json[i]["webImage"] is not None:
-                image_url = rijks_json[i]["webImage"]["url"]
+    artworks = []
+
+    # JSON response: First call
+    met_jsondata = await fetch_met_object(session, f"https://collectionapi.metmuseum.org/public/collection/v1/search?q={quote_plus(keyword)}")
+
+    # No results found in the MET collection (the API returns null objectIDs)
+    met_IDs = met_jsondata.get("objectIDs")
+    if not met_IDs:
+        return
+
+    # Second call: all objects are requested at once, an object that fails is skipped
+    urls = [MET_OBJECT_URL + str(met_ID) for met_ID in met_IDs[:100]]
+    results = await asyncio.gather(*(fetch_met_object(session, url) for url in urls), return_exceptions=True)
+    for url, metID_jsondata in zip(urls, results):
+        if isinstance(metID_jsondata, BaseException):
+            logger.warning("Could not fetch MET object %s", url, exc_info=metID_jsondata)
+        elif 'objectID' in metID_jsondata.keys():
+            row = {column: metID_jsondata.get(key) for column, key in MET_FIELDS}
+            if metID_jsondata["isPublicDomain"] is True:
+                row["image_url"] = metID_jsondata["primaryImage"]
             else:
-                image_url = "static/no_image.jpg"
-            museum = "Rijksmuseum"
-            museum_url= "https://www.rijksmuseum.nl/en"
-
-            # Second call
-            id_response = requests.get("https://www.rijksmuseum.nl/api/en/collection/%s?key=D82d0Rur" % id)
-            id_jsondata = id_response.json()
-            medium = ""
-            date = ""
-            if 'artObjects' in id_jsondata.keys():
-                medium  = id_jsondata["artObjects"]["objectTypes"][0]
-                date = id_jsondata["artObjects"]["dating"]["presentingDate"]
-            
-            # Add artwork to database
-            artwork = Artwork(hash=hash(id), id=id, title=title, artist=artist, medium=medium, date=date, url=url, image_url=image_url, museum=museum, museum_url=museum_url)
-            db.session.add(artwork)
-            db.session.commit()
-
-async def get_data(keyword):
-    """Fetch data from museum APIs."""
-
-    await fetch_va_data(keyword)
-    await fetch_met_data(keyword)
-    await fetch_rijks_data(keyword)
\ No newline at end of file
+                row["image_url"] = "static/no_image.jpg"
+
+            # Queue artwork for the database
+            artworks.append(dict(row, museum="Metropolitan Museum of Art", museum_url="https://www.metmuseum.org/"))
+
+    # Add all artworks to database in one transaction
+    if len(artworks) > 0:
+        db.session.execute(insert(Artwork.__table__), artworks)
+        db.session.commit()
+
+async def fetch_rijks_data(session, keyword):
+    """Obtain information from RIJKSMUSEUM API. Initial call returns basic info over all results.
+    Item specific information is only requested once the item is displayed, see fetch_rijks_details."""
+
+    artworks = []
+
+    # JSON response: First call
+    rijks_jsondata = await fetch_data(session, f"https://www.rijksmuseum.nl/api/en/collection?key=D82d0Rur&q={quote_plus(keyword)}")
+
+    # No results found in the Rijksmuseum collection
+    rijks_json = rijks_jsondata.get("artObjects")
+    if not rijks_json:
+        return
+
+    for record in rijks_json:
+        row = {column: record.get(key) for column, key in RIJKS_FIELDS}
+        row["url"] = record["links"]["web"]
+        if record["webImage"] is not None:
+            row["image_url"] = record["webImage"]["url"]
+        else:
+            row["image_url"] = "static/no_image.jpg"
+
+        # Medium and date need a second call per item: left for fetch_rijks_details
+        row["medium"] = None
+        row["date"] = None
+
+        # Queue artwork for the database
+        artworks.append(dict(row, museum="Rijksmuseum", museum_url="https://www.rijksmuseum.nl/en"))
+
+    # Add all artworks to database in one transaction
+    if len(artworks) > 0:
+        db.session.execute(insert(Artwork.__table__), artworks)
+        db.session.commit()
+
+async def fetch_rijks_detail(session, object_number):
+    """Obtain medium and date of a Rijksmuseum artwork. Second call returns item specific information,
+    i.e., the item ID is used to obtain details. A failed call or missing details give empty values."""
+
+    url = f"https://www.rijksmuseum.nl/api/en/collection/{quote_plus(object_number)}?key=D82d0Rur"
+    try:
+        id_jsondata = await fetch_data(session, url)
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as error:
+        logger.warning("Could not fetch Rijksmuseum details %s", url, exc_info=error)
+        return "", ""
+    if not isinstance(id_jsondata, dict) or 'artObject' not in id_jsondata.keys():
+        logger.warning("No Rijksmuseum details found for %s", object_number)
+        return "", ""
+
+    details = id_jsondata["artObject"]
+    medium = details["objectTypes"][0] if details["objectTypes"] else ""
+    return medium, details["dating"]["presentingDate"] or ""
+
+async def fetch_rijks_details(session, object_numbers):
+    """Obtain (medium, date) of Rijksmuseum artworks, only once they are displayed or filtered on."""
+
+    return await asyncio.gather(*(fetch_rijks_detail(session, object_number) for object_number in object_numbers))
+
+async def get_data(session, keyword):
+    """Fetch data from museum APIs using the shared session. A museum whose fetch fails is logged and skipped,
+    and all fetchers have finished before returning, so none can insert rows into the next search."""
+
+    museums = ("Victoria and Albert Museum", "Metropolitan Museum of Art", "Rijksmuseum")
+    results = await asyncio.gather(fetch_va_data(session, keyword), fetch_met_data(session, keyword), fetch_rijks_data(session, keyword), return_exceptions=True)
+    for museum, result in zip(museums, results):
+        if isinstance(result, BaseException):
+            logger.error("Could not fetch '%s' results from the %s", keyword, museum, exc_info=result)